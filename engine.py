@@ -1,8 +1,37 @@
 #!/usr/bin/env python3
 # backend/engine.py
-import requests, json, os, sys
+import requests, json, os, sys, time, itertools, queue, threading, math
 import logging
+import numpy as np
+from collections import namedtuple
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 try:
     from backend.config import ETHERSCAN_API_KEY, DEFAULT_ETH_AMOUNT, ETH_PRICE_USD, GAS_UNITS_REBALANCE
@@ -12,6 +41,15 @@ except ImportError:
     ETH_PRICE_USD = float(os.environ.get("ETH_PRICE_USD", "1600.0"))
     GAS_UNITS_REBALANCE = int(os.environ.get("GAS_UNITS_REBALANCE", "210000"))
 
+# Endpoint URLs are fixed for the life of the process, so build them once
+_POOLS_URLS = (
+    "https://yields.llama.fi/pools",
+    "https://api.llama.fi/pools",
+    "https://yields.llama.fi/poolsV2"
+)
+_COINGECKO_URL = "https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd"
+_GAS_URL = "https://api.etherscan.io/api?module=gastracker&action=gasoracle&apikey=" + (ETHERSCAN_API_KEY or "")
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,23 +61,114 @@ logging.basicConfig(
 )
 
 OUT_PATH = os.path.join(os.path.dirname(__file__), "snapshot.json")
+# Only the best TOP_K pools are written to the snapshot (0 keeps them all)
+TOP_K = int(os.environ.get("ETHX_TOP_K", "50"))
+# Compact JSON by default; set ETHX_PRETTY=1 for an indented, human-readable snapshot
+PRETTY = os.environ.get("ETHX_PRETTY", "") not in ("", "0")
 
-def fetch_defillama_pools():
-    candidates = [
-        "https://yields.llama.fi/pools",
-        "https://api.llama.fi/pools",
-        "https://yields.llama.fi/poolsV2"
-    ]
-    for url in candidates:
+# One pooled session per kind of fetch so repeat calls reuse the TCP/TLS connection.
+# With requests-cache installed, price and gas lookups within a minute of each
+# other are served from a local SQLite cache instead of the network.
+if requests_cache is not None:
+    _SESSION = requests_cache.CachedSession(
+        os.path.join(os.path.dirname(__file__), "ethx_cache"),
+        backend="sqlite",
+        expire_after=60,
+        allowable_codes=(200,),
+        # Keep the Etherscan key out of the stored requests and the cache keys
+        ignored_parameters=["apikey"]
+    )
+    _SESSION.cache.delete(expired=True)
+else:
+    _SESSION = requests.Session()
+# The pools are fetched on a plain session: a cached one reads the whole body
+# before returning, which defeats streaming it
+_POOLS_SESSION = requests.Session()
+for _s in (_SESSION, _POOLS_SESSION):
+    _s.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+    ))
+    # Ask for every compression urllib3 can decode here (br/zstd only when their
+    # decoders are installed); the pools payload shrinks several times over the wire
+    _s.headers.update({
+        "Accept": "application/json",
+        "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"]
+    })
+
+def _stream_pool_records(body):
+    # Walk the parse events up to the pool list, accepting a bare top-level list
+    # as well as {"data": [...]} like the decoded path, and return an iterator
+    # that parses the records one by one so the full payload never sits in
+    # memory. None means the body holds no pool list.
+    events = ijson.parse(body, use_float=True)
+    for event in events:
+        prefix, kind, _ = event
+        if kind == "start_array" and prefix in ("", "data"):
+            return ijson.items(itertools.chain((event,), events), "data.item" if prefix else "item")
+        if prefix == "" and kind not in ("start_map", "map_key"):
+            break
+    return None
+
+def _fetch_pools_from(url, settled):
+    # Returns the normalized pools from one endpoint, or None if it has no pool
+    # list. The body is parsed here, before the endpoint can win the race, so a
+    # body cut off mid-stream fails this endpoint instead of winning with a
+    # short list.
+    if ijson is not None:
+        r = _POOLS_SESSION.get(url, timeout=12, stream=True)
         try:
-            r = requests.get(url, timeout=12)
-            if r.status_code == 200:
-                try:
-                    return r.json()
-                except Exception:
-                    return r.text
-        except Exception:
-            continue
+            if r.status_code != 200:
+                return None
+            # ijson reads the raw body, so have urllib3 inflate gzip on the fly
+            r.raw.decode_content = True
+            records = _stream_pool_records(r.raw)
+            if records is None:
+                logging.warning("No pool list in response from %s", url)
+                return None
+            # A slower endpoint stops parsing as soon as another one has won
+            return normalize_pools(itertools.takewhile(lambda _: not settled.is_set(), records))
+        finally:
+            # Released on every path, including a body that is not JSON at all
+            r.close()
+    r = _POOLS_SESSION.get(url, timeout=12)
+    if r.status_code == 200:
+        try:
+            payload = _json_loads(r.content)
+        except ValueError as e:
+            # Nothing downstream can use a non-JSON body; let another endpoint win
+            logging.warning("Invalid JSON from %s: %s", url, e)
+            return None
+        if isinstance(payload, list) or (isinstance(payload, dict) and isinstance(payload.get("data"), list)):
+            return normalize_pools(payload)
+        logging.warning("No pool list in response from %s", url)
+    return None
+
+def _race_pools_from(url, answers, settled):
+    try:
+        pools = _fetch_pools_from(url, settled)
+    except Exception as e:
+        # Connection, read and parse errors all leave this endpoint without an answer
+        logging.warning("Failed to fetch pools from %s: %s", url, e)
+        pools = None
+    answers.put(pools)
+
+def fetch_defillama_pools():
+    # Query every endpoint at once and keep the first one that yields a pool
+    # list, so a dead endpoint no longer costs a full timeout before the next
+    # one is tried. The workers are daemon threads: executor workers would be
+    # joined at interpreter exit, keeping the process alive until the slowest
+    # endpoint answered or timed out.
+    answers = queue.Queue()
+    settled = threading.Event()
+    for url in _POOLS_URLS:
+        threading.Thread(target=_race_pools_from, args=(url, answers, settled), daemon=True).start()
+    for _ in _POOLS_URLS:
+        pools = answers.get()
+        if pools is not None:
+            settled.set()
+            return pools
     # print("Failed to fetch pools from DefiLlama endpoints.")
     logging.warning("Failed to fetch pools from DefiLlama endpoints.")
 
@@ -47,19 +176,22 @@ def fetch_defillama_pools():
 
 def fetch_eth_price():
     try:
-        r = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=ethereum&vs_currencies=usd", timeout=8)
+        r = _SESSION.get(_COINGECKO_URL, timeout=8)
         r.raise_for_status()
-        return float(r.json().get("ethereum", {}).get("usd", ETH_PRICE_USD))
+        return float(_json_loads(r.content).get("ethereum", {}).get("usd", ETH_PRICE_USD))
     except Exception:
         return ETH_PRICE_USD
 
 def fetch_gas_gwei():
     try:
-        r = requests.get(f"https://api.etherscan.io/api?module=gastracker&action=gasoracle&apikey={ETHERSCAN_API_KEY}", timeout=8)
+        r = _SESSION.get(_GAS_URL, timeout=8)
         r.raise_for_status()
-        jr = r.json()
+        jr = _json_loads(r.content)
         if jr.get("result"):
-            return float(jr["result"].get("ProposeGasPrice") or jr["result"].get("SafeGasPrice") or jr["result"].get("FastGasPrice") or 50)
+            gas = float(jr["result"].get("ProposeGasPrice") or jr["result"].get("SafeGasPrice") or jr["result"].get("FastGasPrice") or 50)
+            # float() accepts "NaN" and "inf"; neither is a usable gas price
+            if math.isfinite(gas):
+                return gas
     except Exception:
         pass
     return 50.0
@@ -77,61 +209,90 @@ def estimate_gas_eth(gas_units, gas_gwei):
     wei = gas_units * gas_gwei * 1e9
     return wei/1e18
 
-def compute_net_apy(base_apy_decimal, gas_eth, eth_price_usd, user_eth_amount):
-    stake_usd = user_eth_amount * eth_price_usd
-    gas_usd = gas_eth * eth_price_usd
-    gas_impact_pct = (gas_usd / stake_usd) if stake_usd > 0 else 0.0
-    net = base_apy_decimal - gas_impact_pct
-    return max(0.0, net)
+if njit is not None:
+    # Compiled once and cached on disk next to the module, so later runs skip the JIT
+    @njit(cache=True)
+    def _compute_net(apy, gas_impact):
+        out = np.empty_like(apy)
+        for i in range(apy.shape[0]):
+            v = apy[i] - gas_impact
+            out[i] = v if v > 0.0 else 0.0
+        return out
+else:
+    def _compute_net(apy, gas_impact):
+        net = apy - gas_impact
+        # Same clamp as the kernel: a NaN compares false and maps to 0.0, as with max(0.0, net)
+        return np.where(net > 0.0, net, 0.0)
+
+_ETH_SET = frozenset(("ETH", "WETH"))
+
+# Pools that pass the filter; far lighter than a dict per record, and only the
+# TOP_K that reach the snapshot are turned into dicts
+Pool = namedtuple("Pool", "protocol symbol tvl base_apy url")
 
 def normalize_pools(raw):
+    # raw is a decoded payload or the record iterator over a streamed body; read
+    # and parse errors from the stream are left to the caller
     out = []
     if not raw:
         return out
-    arr = raw.get("data", raw) if isinstance(raw, dict) else raw
-    for p in arr:
+    for p in (raw.get("data", raw) if isinstance(raw, dict) else raw):
+        # Malformed records are skipped explicitly instead of by a blanket except
+        if not isinstance(p, dict):
+            continue
+        g = p.get
+        # Filter pools by symbol, then TVL, before anything else: most pools
+        # are not ETH/WETH and are rejected after a single lookup
+        symbol = g("symbol", "")
+        if not isinstance(symbol, str) or symbol not in _ETH_SET:
+            continue
         try:
-            project = (p.get("project") or p.get("pool") or p.get("title") or p.get("name") or "").strip()
-            symbol = p.get("symbol") or ""
-            # apy = p.get("apy") or p.get("apyBase") or p.get("apyMean30d") or 0
-            apy = p.get("apy") or p.get("apyBase") or 0.0
-            # apy = percent_to_decimal(apy)  # convert to decimal
-            tvl = p.get("tvlUsd") or p.get("tvl") or 0
-
-            # Construct pool URL if available, fallback to DefiLlama
-            pool_id = p.get("pool") or ""
-	    # pool_id = p.get("id") or p.get("pool") or p.get("poolId") or ""
-            # url = f"https://defillama.com/yields/pool/{pool_id}" if pool_id else None
-
-            # Filter pools by TVL and APY
-       	    if tvl > 10000 and symbol in ["ETH", "WETH"]:
-                out.append({
-                    "protocol": project,
-                    "symbol": symbol,
-                    "base_apy":apy,
-                    "tvlUsd": tvl,
-		#    "url": f"https://app.defillama.com/pool/{p.get('pool')}" if p.get("pool") else "n/a"
-		    "url": f"https://defillama.com/yields/pool/{pool_id}" if pool_id else "n/a"
-                  			
-                })
-        except Exception:
+            tvl = float(g("tvlUsd") or g("tvl") or 0)
+        except (TypeError, ValueError, OverflowError):
             continue
+        # float() accepts "NaN" and "inf"; neither is a usable TVL or APY
+        if not (math.isfinite(tvl) and tvl > 10000):
+            continue
+
+        # apy = g("apy") or g("apyBase") or g("apyMean30d") or 0
+        try:
+            apy = float(g("apy") or g("apyBase") or 0.0)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        if not math.isfinite(apy):
+            continue
+        # apy = percent_to_decimal(apy)  # convert to decimal
+
+        # Construct pool URL if available, fallback to DefiLlama
+        pool_id = g("pool") or ""
+        project = str(g("project") or pool_id or g("title") or g("name") or "").strip()
+
+        out.append(Pool(
+            project,
+            symbol,
+            tvl,
+            apy,
+            f"https://defillama.com/yields/pool/{pool_id}" if pool_id else "n/a"
+        ))
     return out
 
 def build_snapshot(user_eth_amount=DEFAULT_ETH_AMOUNT):
 
-    raw = fetch_defillama_pools()
-    pools = normalize_pools(raw)
-    eth_price = fetch_eth_price()
-    gas_gwei = fetch_gas_gwei()
+    # The three fetches are independent and network-bound; run them concurrently
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        f_pools = ex.submit(fetch_defillama_pools)
+        f_px = ex.submit(fetch_eth_price)
+        f_gas = ex.submit(fetch_gas_gwei)
+    pools, eth_price, gas_gwei = f_pools.result(), f_px.result(), f_gas.result()
     gas_eth = estimate_gas_eth(GAS_UNITS_REBALANCE, gas_gwei)
 
 
-    logging.info(f"Fetched {len(pools)} pools from DefiLlama")
-    logging.info(f"ETH price: ${eth_price}, Gas: {gas_gwei} gwei, Gas impact: {gas_eth:.6f} ETH")
+    logging.info("Fetched %d pools from DefiLlama", len(pools))
+    logging.info("ETH price: $%s, Gas: %s gwei, Gas impact: %.6f ETH", eth_price, gas_gwei, gas_eth)
 
     snapshot = {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        # Second precision is plenty for a snapshot and skips the microsecond formatting
+        "timestamp": datetime.fromtimestamp(time.time(), timezone.utc).isoformat(timespec="seconds"),
         "eth_price_usd": eth_price,
         "gas_gwei": gas_gwei,
         "gas_eth": gas_eth,
@@ -139,33 +300,39 @@ def build_snapshot(user_eth_amount=DEFAULT_ETH_AMOUNT):
         "results": []
     }
 
-    for p in pools:
-        try:
-            base = p.get("base_apy", 0.0)
-            net = compute_net_apy(base, gas_eth, eth_price, user_eth_amount)
-            snapshot["results"].append({
-                "protocol": p.get("protocol"),
-                "symbol": p.get("symbol"),
-                "tvlUsd": p.get("tvlUsd"),
-                "base_apy": round(base,6),
-                "net_apy": round(net,6),
-                "url": p.get("url")   # <-- ADD THIS LINE
-            })
-
-        #    logging.info(f"Pool added: {p.get('protocol')} {p.get('symbol')} base {round(base,2)}% net {round(net,2)}%")
-        except Exception as e:
-            logging.error(f"Error processing pool {p}: {e}")
-        # except Exception:
-        #    continue
-
-    snapshot["results"] = sorted(snapshot["results"], key=lambda x: x["net_apy"], reverse=True)
+    # Net APY for all pools in one vectorized pass, ranked by a single argsort;
+    # result dicts are only built for the TOP_K that make it into the snapshot
+    apy_arr = np.fromiter(map(attrgetter("base_apy"), pools), dtype=np.float64, count=len(pools))
+    # Gas cost as a fraction of the stake, computed once; the ETH price cancels
+    # out of gas_usd / stake_usd
+    gas_impact = gas_eth / user_eth_amount if user_eth_amount > 0 and eth_price > 0 else 0.0
+    net_arr = _compute_net(apy_arr, gas_impact)
+    order = np.argsort(-net_arr, kind="stable")
+    if TOP_K > 0:
+        order = order[:TOP_K]
+
+    snapshot["results"] = [{
+        "protocol": p.protocol,
+        "symbol": p.symbol,
+        "tvlUsd": p.tvl,
+        "base_apy": round(p.base_apy, 6),
+        "net_apy": round(net, 6),
+        "url": p.url
+    } for p, net in zip([pools[i] for i in order.tolist()], net_arr[order].tolist())]
 
     try:
         os.makedirs(os.path.dirname(OUT_PATH), exist_ok=True)
-        with open(OUT_PATH, "w") as f:
-            json.dump(snapshot, f, indent=2)
+        if orjson is not None:
+            data = orjson.dumps(snapshot, option=orjson.OPT_INDENT_2 if PRETTY else 0)
+        else:
+            data = json.dumps(snapshot, indent=2 if PRETTY else None, separators=None if PRETTY else (",", ":")).encode()
+        # Swap in a fully written file so readers never see a partial snapshot
+        tmp = OUT_PATH + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, OUT_PATH)
     except Exception as e:
-        logging.error(f"Failed to write snapshot: {e}")
+        logging.error("Failed to write snapshot: %s", e)
     return snapshot
 
 if __name__ == '__main__':
@@ -174,10 +341,10 @@ if __name__ == '__main__':
         try:
             amt = float(sys.argv[1])
         except:
-            logging.warning(f"Invalid ETH amount input: {sys.argv[1]}, using default {DEFAULT_ETH_AMOUNT}")
+            logging.warning("Invalid ETH amount input: %s, using default %s", sys.argv[1], DEFAULT_ETH_AMOUNT)
             # pass
     s = build_snapshot(amt)
-    logging.info(f"Snapshot built: {s.get('timestamp')}")
+    logging.info("Snapshot built: %s", s.get("timestamp"))
     logging.info("Top results:")	
     # print("Snapshot built:", s.get("timestamp"))
     # print("Top results:")